@@ -0,0 +1,173 @@
+#!/usr/bin/env python  # -*- coding: utf-8 -*-
+#
+# 収集プロセスの監視(SwitchBot/AiSEGを別プロセスで実行)
+# Copyright (c) 2024 rinos4u, released under the MIT open source license.
+#
+# 2024.10.20 rinos4u	new
+
+# BLEスキャン(bluepy)やAiSEGのHTMLパースをWebサーバとは別プロセスで動かし、
+# 結果をワーカ毎のパイプ経由でWebサーバ側に渡す。
+# プロセスが落ちた場合や応答が無くなった場合は自動で再起動する。
+# 起動直後に落ち続ける場合(BLEアダプタが無いなど)は、再起動の間隔を倍々に延ばす。
+# Webサーバのスレッドが保持中のロックを引き継がないよう、ワーカはforkではなくspawnで起動する。
+# (spawnではメインスクリプトも読み直されるため、webapp.pyのトップレベルには重い処理を置かないこと)
+
+################################################################################
+# import
+################################################################################
+from logging import getLogger
+from datetime import datetime
+from multiprocessing import connection
+import multiprocessing
+import time
+
+import aiseg2
+import switchbot
+
+################################################################################
+# const
+################################################################################
+LOG_KEY			= 'collector'
+
+WORKER_BOT		= 'switchbot'
+WORKER_AS2		= 'aiseg2'
+
+SCAN_WAIT		= 70	# AiSEG側がBLEスキャン完了を待つ最大時間[s] (SwitchBot側が停止していても取得は継続)
+FETCH_WAIT		= 30	# SwitchBot側がAiSEG取得完了を待つ最大時間[s]
+WORKER_TIMEOUT	= 300	# この時間以上結果が届かないワーカはハングとみなして再起動[s]
+RECV_POLL		= 1		# 受信待ちの間隔(この間隔でワーカを監視)[s]
+RESTART_WAIT	= 1		# 再起動までの待ち時間の初期値[s] (連続で失敗する毎に倍にする)
+RESTART_MAX		= 600	# 再起動までの待ち時間の最大値[s]
+
+################################################################################
+# globals
+################################################################################
+# ロガー(ログ設定はswitchbot/aiseg2のimport時に読み込み済み)
+g_logger = getLogger(LOG_KEY)
+
+################################################################################
+# worker (子プロセス側)
+################################################################################
+# SwitchBot(Bluetooth)とAiSEG(WiFi)の干渉を防ぐため、イベントで交互に実行させる
+def worker_switchbot(conn, scanned, fetched):
+	while True:
+		# AiSEG取得中はスキャンしない
+		fetched.wait(FETCH_WAIT)
+		fetched.clear()
+
+		# スイッチボットキャプチャ(BLEスキャン)
+		left = 60 - datetime.now().second
+		bot = switchbot.get_switchbot(left) if left > 0 else {}
+		conn.send(bot)
+		scanned.set()
+
+def worker_aiseg2(conn, scanned, fetched):
+	while True:
+		# BLEスキャンが終わってから取得
+		scanned.wait(SCAN_WAIT)
+		scanned.clear()
+
+		# AiSEG取得(HTTPパース)
+		as2 = aiseg2.get_aiseg2()
+		conn.send(as2)
+		fetched.set()
+
+################################################################################
+# Collector (親プロセス側)
+################################################################################
+class Collector:
+	def __init__(self):
+		self.ctx     = multiprocessing.get_context('spawn')
+		self.scanned = self.ctx.Event()
+		self.fetched = self.ctx.Event()
+		self.fetched.set() # 初回はすぐにスキャン開始
+		self.targets = {
+			WORKER_BOT: worker_switchbot,
+			WORKER_AS2: worker_aiseg2,
+		}
+		self.procs = {}
+		self.conns = {}	# 再起動待ちのワーカは含まない
+		self.last  = {}
+		self.fails = {name: 0 for name in self.targets}	# 連続で失敗した回数(結果が届いたら0)
+		self.retry = {}	# 再起動する時刻
+
+	# ワーカプロセスの起動(再起動)
+	# 送信中に強制終了したワーカのパイプは壊れている可能性があるため、起動毎に作り直す
+	def spawn(self, name):
+		recv, send = self.ctx.Pipe(duplex=False)
+		proc = self.ctx.Process(target=self.targets[name], args=(send, self.scanned, self.fetched), name=name, daemon=True)
+		proc.start()
+		send.close() # 親側の送信端は閉じておく(ワーカ終了時にEOFを検出するため)
+		self.procs[name] = proc
+		self.conns[name] = recv
+		self.last[name]  = time.time()
+		g_logger.info("spawn %s pid=%d", name, proc.pid)
+
+	def start(self):
+		for name in self.targets:
+			self.spawn(name)
+
+	# ワーカを停止してパイプを閉じ、再起動を予約する
+	def stop(self, name):
+		proc = self.procs[name]
+		if proc.is_alive():
+			proc.terminate()
+			proc.join(5)
+			if proc.is_alive():
+				proc.kill()
+		proc.join(0)
+		self.conns.pop(name).close()
+
+		self.fails[name] += 1
+		wait = min(RESTART_MAX, RESTART_WAIT * 2 ** (self.fails[name] - 1))
+		self.retry[name] = time.time() + wait
+		g_logger.info("restart %s in %d s (fails=%d)", name, wait, self.fails[name])
+
+	# 落ちたワーカやハングしたワーカを止め、待ち時間が過ぎたら再起動
+	def supervise(self):
+		now = time.time()
+		for name, proc in self.procs.items():
+			if name not in self.conns:
+				if now >= self.retry[name]:
+					self.spawn(name)
+			elif not proc.is_alive():
+				g_logger.error("worker %s exited (code=%s)", name, proc.exitcode)
+				self.stop(name)
+			elif now - self.last[name] > WORKER_TIMEOUT:
+				g_logger.error("worker %s timeout. terminate", name)
+				self.stop(name)
+
+	# 1分毎の収集結果(bot, as2)を順に返す
+	def records(self):
+		bot = {}
+		pending = False # AiSEG待ちのBLEデータあり
+		while True:
+			if not self.conns: # 全て再起動待ち
+				time.sleep(RECV_POLL)
+				self.supervise()
+				continue
+			ready = connection.wait(list(self.conns.values()), timeout=RECV_POLL)
+			if not ready:
+				self.supervise()
+				continue
+
+			for name, conn in list(self.conns.items()): # BLE→AiSEGの順に処理
+				if conn not in ready:
+					continue
+				try:
+					dat = conn.recv()
+				except (EOFError, OSError): # ワーカ終了なら再起動
+					g_logger.error("worker %s pipe closed", name)
+					self.stop(name)
+					continue
+
+				self.last[name]  = time.time()
+				self.fails[name] = 0
+				if name == WORKER_BOT:
+					if pending: # AiSEG側が間に合わなかった場合はBLEデータのみで記録
+						yield bot, {}
+					bot = dat
+					pending = True
+				else: # BLE側が止まっている場合は古いデータを使い回さない
+					yield (bot if pending else {}), dat
+					pending = False
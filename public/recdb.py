@@ -0,0 +1,234 @@
+#!/usr/bin/env python  # -*- coding: utf-8 -*-
+#
+# 記録データのSQLite保存(時系列DB)
+# Copyright (c) 2024 rinos4u, released under the MIT open source license.
+#
+# 2024.10.20 rinos4u	new
+
+# 1分毎のレコード [ut, {デバイス: {'dat': {項目: 値}, 'ut': 更新時刻}}] を
+# (時刻, デバイス, 項目)単位の行に分解して保存し、時刻の範囲で読み出す。
+# デバイス名/項目名は別表の整数IDで持ち、数値はそのまま(それ以外はJSON文字列)で保存する。
+# SDカード寿命を考慮して、書き込みはDB_BATCH分まとめて行う。
+# 読み出しは呼び出し毎に別の接続で行い(WALなので書き込みと並行できる)、書き込み用のロックを持たない。
+# 日付毎の行数は集計表(day)に持ち、日付一覧はここから返す。
+#
+# 使い方(コマンドライン):
+# $ python recdb.py import archive/rec*.txt.gz   既存アーカイブをDBに取り込む
+# $ python recdb.py export 20241020 ...          DBから従来形式のアーカイブを書き出す(日付省略時は全日)
+
+################################################################################
+# import
+################################################################################
+from datetime import datetime, timedelta
+from contextlib import closing
+import threading
+import argparse
+import sqlite3
+import json
+import gzip
+import glob
+import os
+
+import recdelta
+
+################################################################################
+# const
+################################################################################
+DB_FILE		= 'archive/record.db'
+DB_VERSION	= 2		# DB形式の版(形式を変えたら上げる)
+DB_BATCH	= 10	# 10分毎にまとめて書き込み
+
+ARC_PATH	= 'archive'
+ARC_FILE	= 'rec%s.txt.gz'
+
+DEV_UT		= '@ut'	# デバイスの更新時刻を保存する項目名
+
+################################################################################
+# globals
+################################################################################
+g_path = DB_FILE
+g_conn = None				# 書き込み用の接続
+g_lock = threading.Lock()	# 書き込み(g_conn/g_buf/g_ids)を収集スレッドとWebスレッドで排他
+g_buf  = []					# DB未書き込みのレコード
+g_ids  = {'dev': {}, 'metric': {}}	# 名前 → ID
+
+################################################################################
+# util funcs
+################################################################################
+# 値 → DB値 (数値はそのまま、それ以外はJSON文字列)
+def to_val(val):
+	return val if type(val) in (int, float) else json.dumps(val, ensure_ascii=False)
+
+# DB値 → 値
+def from_val(val):
+	return json.loads(val) if isinstance(val, str) else val
+
+# レコード → 行(時刻, デバイス名, 項目名, DB値)
+def to_rows(rec):
+	ut, snap = rec
+	rows = []
+	for dev, v in snap.items():
+		rows.append((ut, dev, DEV_UT, v['ut']))
+		for metric, val in v['dat'].items():
+			rows.append((ut, dev, metric, to_val(val)))
+	return rows
+
+# 行(時刻順) → レコード
+def from_rows(rows):
+	ret = []
+	for ut, dev, metric, val in rows:
+		if not ret or ret[-1][0] != ut:
+			ret.append([ut, {}])
+		obj = ret[-1][1].setdefault(dev, {'dat': {}, 'ut': 0})
+		if metric == DEV_UT:
+			obj['ut'] = val
+		else:
+			obj['dat'][metric] = from_val(val)
+	return ret
+
+# ローカルタイムの日付(YYYYMMDD)の範囲[start, end)
+def day_range(day):
+	st = datetime.strptime(day, '%Y%m%d')
+	return int(st.timestamp()), int((st + timedelta(days=1)).timestamp())
+
+# ローカルタイムの日付(YYYYMMDD)
+def day_of(ut):
+	return datetime.fromtimestamp(ut).strftime('%Y%m%d')
+
+################################################################################
+# DB access
+################################################################################
+def open_db(path=DB_FILE):
+	global g_conn, g_path
+	os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+	g_path = path
+	g_conn = sqlite3.connect(path, check_same_thread=False)
+	g_conn.execute('PRAGMA journal_mode=WAL')
+	g_conn.execute('PRAGMA synchronous=NORMAL')
+
+	ver = g_conn.execute('PRAGMA user_version').fetchone()[0]
+	if ver != DB_VERSION:
+		if g_conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]:
+			raise RuntimeError('%s: DB形式が異なります(ver %d)。削除してアーカイブから取り込み直してください' % (path, ver))
+		g_conn.execute('CREATE TABLE dev (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+		g_conn.execute('CREATE TABLE metric (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+		g_conn.execute('''CREATE TABLE rec (
+			ut		INTEGER NOT NULL,
+			dev		INTEGER NOT NULL,
+			metric	INTEGER NOT NULL,
+			val,
+			PRIMARY KEY (ut, dev, metric)) WITHOUT ROWID''')
+		g_conn.execute('CREATE TABLE day (day TEXT PRIMARY KEY, cnt INTEGER NOT NULL)')
+		g_conn.execute('PRAGMA user_version = %d' % DB_VERSION)
+		g_conn.commit()
+
+	for table, ids in g_ids.items():
+		ids.clear()
+		ids.update({name: id for id, name in g_conn.execute('SELECT id, name FROM %s' % table)})
+
+# 読み出し用の接続(呼び出し側で閉じる)
+def reader():
+	conn = sqlite3.connect(g_path)
+	conn.execute('PRAGMA query_only=1')
+	return conn
+
+# デバイス名/項目名のID (無ければ登録。g_lock内で呼ぶ)
+def get_id(table, name):
+	ids = g_ids[table]
+	if name not in ids:
+		g_conn.execute('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table, (name,))
+		ids[name] = g_conn.execute('SELECT id FROM %s WHERE name = ?' % table, (name,)).fetchone()[0]
+	return ids[name]
+
+# レコードを追加(DB_BATCH分貯まったら書き込み)
+def add(rec):
+	with g_lock:
+		g_buf.append(rec)
+		if len(g_buf) < DB_BATCH:
+			return
+	flush()
+
+# 貯めたレコードを書き込み(同じ時刻/デバイス/項目は重複登録しない)
+# 実際に追加した行数を日付毎の集計表に加算する
+def flush():
+	global g_buf
+	with g_lock:
+		if not g_buf:
+			return
+		cnt = {}
+		for rec in g_buf:
+			rows = [(ut, get_id('dev', dev), get_id('metric', metric), val) for ut, dev, metric, val in to_rows(rec)]
+			before = g_conn.total_changes
+			g_conn.executemany('INSERT OR IGNORE INTO rec VALUES (?, ?, ?, ?)', rows)
+			day = day_of(rec[0])
+			cnt[day] = cnt.get(day, 0) + g_conn.total_changes - before
+		g_conn.executemany('INSERT INTO day VALUES (?, ?) ON CONFLICT(day) DO UPDATE SET cnt = cnt + excluded.cnt', cnt.items())
+		g_conn.commit()
+		g_buf = []
+
+# 指定範囲(start <= ut < end)のレコードを返す
+def get_range(start, end):
+	# 書き込み中の分を取りこぼさないよう、DBを読む前に未書き込み分を控えておく(重複は統合時に除外)
+	with g_lock:
+		buf = [rec for rec in g_buf if start <= rec[0] < end]
+	with closing(reader()) as conn:
+		cur = conn.execute('''SELECT r.ut, d.name, m.name, r.val FROM rec r
+			JOIN dev d ON d.id = r.dev JOIN metric m ON m.id = r.metric
+			WHERE r.ut >= ? AND r.ut < ? ORDER BY r.ut''', (start, end))
+		ret = from_rows(cur)
+	# 未書き込み分も含める(別ノードの統合分は書き込み済みの分より古い場合があるので時刻順に統合)
+	for rec in buf:
+		recdelta.merge(ret, rec)
+	return ret
+
+# データが存在する日付(YYYYMMDD)と行数 (year=0なら全て)
+# 行数はクライアントのキャッシュ検証用(後から統合や取り込みがあれば変わる)
+def days(year=0):
+	with closing(reader()) as conn:
+		ret = {day: cnt for day, cnt in conn.execute('SELECT day, cnt FROM day ORDER BY day')}
+	return {day: cnt for day, cnt in ret.items() if not year or int(day[:4]) == year}
+
+# 指定日のデータを従来のアーカイブ形式(gz圧縮前のテキスト)で返す (encを指定すると差分エンコード)
+def export(day, enc=None):
+	recs = get_range(*day_range(day))
+	if enc:
+		recs = enc.encode_all(recs)
+	return ',\n'.join([json.dumps(rec, ensure_ascii=False) for rec in recs]).encode()
+
+################################################################################
+# Archive import/export
+################################################################################
+def import_archive(files):
+	for file in files:
+		with gzip.open(file, 'rt', encoding='utf-8') as f:
+			recs = recdelta.decode(json.loads('[' + f.read() + ']'))
+		for rec in recs:
+			add(rec)
+		flush()
+		print('import %s: %d' % (file, len(recs)))
+
+def export_archive(dates):
+	os.makedirs(ARC_PATH, exist_ok=True)
+	for day in dates or days():
+		dat = export(day)
+		if not dat:
+			continue
+		with gzip.open(ARC_PATH + '/' + ARC_FILE % day, mode='wb') as f:
+			f.write(dat)
+		print('export %s: %d byte' % (day, len(dat)))
+
+################################################################################
+# main
+################################################################################
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='EnvLog record DB tool')
+	parser.add_argument('cmd', choices=['import', 'export'])
+	parser.add_argument('args', nargs='*', help='import: アーカイブファイル, export: 日付(YYYYMMDD)')
+	parser.add_argument('--db', default=DB_FILE, help='DBファイル')
+	args = parser.parse_args()
+
+	open_db(args.db)
+	if args.cmd == 'import':
+		import_archive([f for arg in args.args for f in sorted(glob.glob(arg))])
+	else:
+		export_archive(args.args)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python  # -*- coding: utf-8 -*-
+#
+# 記録データの差分エンコード
+# Copyright (c) 2024 rinos4u, released under the MIT open source license.
+#
+# 2024.10.20 rinos4u	new
+
+# 1分毎のレコード [ut, {デバイス: {'dat': {項目: 値}, 'ut': 更新時刻}}] を
+# 一定時間毎のキーフレーム(従来と同じ形式)と、その間の差分レコードで表す。
+#   キーフレーム: [ut, {全デバイス}]  (時刻がinterval分の区切りを跨いだ最初のレコード)
+#   差分レコード: [ut, {変化したデバイス: {'dat': {変化した項目}, 'ut': 更新時刻}}, 'd']
+#                 消えたデバイス/項目の値はnull。デバイスの'ut'がレコードのutと同じなら省略
+#                 AiSEGの[[W, 名前], ...]形式のリストは、名前の並びが同じなら {'w': [W, ...]}、
+#                 並びが変わったら {'r': [[W, 前リストの位置 or 新しい名前], ...]} で表す
+#   統合レコード: [ut, {別ノードのデバイス}, 'm']  (record.txtのみ。同じ分のレコードに後から統合する)
+# 差分レコードは直前のレコードに適用して復元するため、ファイルや応答の先頭は必ずキーフレームにすること。
+
+################################################################################
+# import
+################################################################################
+import bisect
+
+################################################################################
+# const
+################################################################################
+DELTA = 'd'	# 差分レコードの識別子(3要素目)
+MERGE = 'm'	# 統合レコードの識別子(3要素目)
+
+################################################################################
+# util funcs
+################################################################################
+# [[W, 名前], ...]形式のリストか
+def is_wattlist(v):
+	return isinstance(v, list) and all(isinstance(w, list) and len(w) == 2 for w in v)
+
+# 項目値の差分 (ワットリストは名前を繰り返さない)
+def diff_val(prev, cur):
+	if not (is_wattlist(prev) and is_wattlist(cur)):
+		return cur
+	if [w[1] for w in prev] == [w[1] for w in cur]:
+		return {'w': [w[0] for w in cur]}
+	names = {w[1]: i for i, w in enumerate(prev)}
+	return {'r': [[w[0], names.get(w[1], w[1])] for w in cur]}
+
+# 項目値に差分を適用
+def patch_val(prev, val):
+	if not isinstance(val, dict):
+		return val
+	if 'w' in val:
+		return [[w, prev[i][1]] for i, w in enumerate(val['w'])]
+	return [[w, prev[r][1] if isinstance(r, int) else r] for w, r in val['r']]
+
+# 前スナップショットからの差分 (utはレコードの時刻。デバイスの更新時刻と同じなら省略)
+def diff(prev, cur, ut=None):
+	ret = {}
+	for dev, v in cur.items():
+		p = prev.get(dev)
+		if p == v:
+			continue # 変化なし
+		if p is None:
+			ret[dev] = v # 新規デバイスは全項目
+			continue
+		dat = {k: diff_val(p['dat'].get(k), val) for k, val in v['dat'].items() if p['dat'].get(k) != val}
+		dat |= {k: None for k in p['dat'] if k not in v['dat']}
+		ret[dev] = {'dat': dat}
+		if v['ut'] != ut:
+			ret[dev]['ut'] = v['ut']
+
+	for dev in prev:
+		if dev not in cur:
+			ret[dev] = None # 消えたデバイス
+	return ret
+
+# 前スナップショットに差分を適用 (utはレコードの時刻)
+def patch(prev, delta, ut=None):
+	cur = dict(prev)
+	for dev, v in delta.items():
+		if v is None:
+			cur.pop(dev, None)
+			continue
+		old = prev[dev]['dat'] if dev in prev else {}
+		dat = old | {k: patch_val(old.get(k), val) for k, val in v['dat'].items()}
+		cur[dev] = {
+			'dat': {k: val for k, val in dat.items() if val is not None},
+			'ut' : v.get('ut', ut),
+		}
+	return cur
+
+# レコード列(時刻順)の同じ分のレコードにデバイスを統合する。同じ分が無ければ時刻順に挿入
+# 既にあるデバイスは上書きしない(重複受信の除外)。実際に追加した分を[ut, {デバイス}]で返す
+def merge(recs, rec):
+	ut, snap = rec[0], rec[1]
+	m   = ut // 60
+	idx = bisect.bisect_left(recs, m, key=lambda v: v[0] // 60)
+	if idx < len(recs) and recs[idx][0] // 60 == m:
+		add = {k: v for k, v in snap.items() if k not in recs[idx][1]}
+		if add: # 差分エンコーダが参照中のdictは変更しない
+			recs[idx] = [recs[idx][0], recs[idx][1] | add]
+		return [recs[idx][0], add]
+
+	recs.insert(idx, [ut, snap])
+	return [ut, snap]
+
+# キーフレーム/差分/統合レコードの列をフルスナップショットの列に復元
+# (baseは先頭が差分レコードの場合の基準スナップショット)
+def decode(recs, base=None):
+	ret  = []
+	last = base if base is not None else {}
+	for rec in recs:
+		if len(rec) > 2 and rec[2] == MERGE:
+			merge(ret, rec) # 差分の基準(last)には含めない
+			continue
+		last = patch(last, rec[1], rec[0]) if len(rec) > 2 and rec[2] == DELTA else rec[1]
+		ret.append([rec[0], last])
+	return ret
+
+################################################################################
+# Encoder
+################################################################################
+class Encoder:
+	def __init__(self, interval):
+		self.interval = interval # キーフレーム間隔[分]
+		self.reset()
+
+	# 次のレコードをキーフレームにする
+	def reset(self):
+		self.last = None # 直前のレコード
+
+	# キーフレームは時計の区切り(interval分毎)で入れる
+	# 応答毎にエンコーダを作り直しても、受信側は一定時間毎にキーフレームを受け取れる
+	def encode(self, rec):
+		ut, snap = rec
+		if self.last is None or ut // 60 // self.interval != self.last[0] // 60 // self.interval:
+			ret = rec
+		else:
+			ret = [ut, diff(self.last[1], snap, ut), DELTA]
+		self.last = rec
+		return ret
+
+	# レコード列をまとめてエンコード
+	# 先頭はキーフレーム。受信側が持っている直前のレコード(base)を指定すると、同じ区切り内なら先頭から差分にする
+	def encode_all(self, recs, base=None):
+		self.reset()
+		self.last = base
+		return [self.encode(rec) for rec in recs]
@@ -8,6 +8,7 @@
 # インストールモジュール
 #pip install flask
 #pip install Flask-HTTPAuth
+#pip install requests
 
 # 外部アクセス＆HTTPS化 → https://ngrok.com/   ([Sign Up for free]で無料アカウント利用可)
 # インストール(ngrokサイトから取得)：[Securty Tunnel] - [Agents] - [Download an Agent] - [RasberryPi] - [Download] - [ARM64(ARMv8)]
@@ -21,19 +22,25 @@
 ################################################################################
 # import
 ################################################################################
-from flask import Flask, send_from_directory, jsonify, make_response
+from flask import Flask, send_from_directory, jsonify, make_response, request
 from flask_httpauth import HTTPBasicAuth
 from datetime import datetime, timedelta
 import threading
 import time
 import json
+import argparse
+import requests
 
 import os
 import gzip
-import shutil
+import zlib
+import mimetypes
 
 import aiseg2
 import switchbot
+import collector
+import recdb
+import recdelta
 
 ################################################################################
 # const
@@ -46,6 +53,15 @@ ARC_FILE = 'rec%s.txt.gz'
 HTTP_AUTH = 'httpauth.json'
 HTTP_PORT = 8080
 
+ASSET_PATH = 'assets'			# Viteビルドのハッシュ付きファイル名のJS/CSS
+ASSET_AGE  = 365 * 24 * 3600	# ハッシュ付きファイルは内容が変わらないので1年キャッシュ
+PRECOMP    = (('br', '.br'), ('gzip', '.gz')) # ビルド時に生成した圧縮ファイル(優先順)
+
+RANGE_MAX  = 7 * 24 * 3600		# DBから一度に読み出す最大範囲[s] (クライアントの保持期間と同じ1週間)
+
+FORWARD_KEY     = 60	# 転送時のキーフレーム間隔[分]
+FORWARD_TIMEOUT = 20	# 転送タイムアウト[s]
+
 ################################################################################
 # globals
 ################################################################################
@@ -54,15 +70,155 @@ auth = HTTPBasicAuth()
 app.config['JSON_AS_ASCII'] = False
 app.config['SECRET_KEY'] = 'secret key'
 
-# ダイジェスト認証のuser/passリスト読み込み（平文‥）
-g_httpauth = json.load(open(HTTP_AUTH, encoding="utf-8"))
+# ダイジェスト認証のuser/passリスト（平文‥）
+# -pオプションのワーカ起動(spawn)時にも本ファイルが読み込まれるため、読み込みはmainで行う
+g_httpauth = {}
 # メモリ上でデータを保持するリスト
 g_data = []
+# SQLite保存モード(-dオプション)
+g_db = False
+# 差分記録モード(-kオプション)のエンコーダ
+g_enc = None
+# 別ノードから受信した、まだ記録していない分のデバイス {分: [時刻, {ノード名/デバイス: データ}]}
+g_remote = {}
+# 現在のrecord.txtが対象とする期間の開始時刻(これより前の分はアーカイブ済み)
+g_rec_start = 0
+# /difで送信済みの最新レコードの時刻と、送信後に別ノードのデバイスを統合したレコードの時刻
+# (統合前に受信したクライアントとスナップショットが異なるため、差分の基準にしない)
+g_sent_ut = 0
+g_dirty   = set()
+# g_data/g_remote/g_sent_ut/g_dirtyは収集スレッドと受信(/ing)で更新するため排他する
+g_lock = threading.Lock()
+
+# 差分記録モードなら応答も差分エンコードする
+# 先頭はキーフレーム。クライアントが持っている直前のレコード(base)が分かれば先頭から差分にする
+def encode_records(recs, base=None):
+	return recdelta.Encoder(g_enc.interval).encode_all(recs, base) if g_enc else recs
+
+# RAM diskにレコードを追記
+def write_record(rec):
+	with open(REC_FILE, 'a') as f:
+		if  f.tell(): # 継続ならJSON整形用にコンマ追加
+			f.write(',\n')
+		f.write(json.dumps(rec, ensure_ascii=False))
+		f.flush()
+
+# 最大数を超えた古いデータを削除 (g_lock内で呼ぶ)
+def trim_data():
+	global g_dirty
+	if len(g_data) > MAX_DATA:
+		del g_data[:len(g_data) - MAX_DATA]
+		g_dirty = {ut for ut in g_dirty if ut >= g_data[0][0]}
+
+# ローカルタイムの日付の開始時刻
+def day_start(ut):
+	return int(datetime.fromtimestamp(ut).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+# 記録済みの分に別ノードのデバイスを統合して記録(既にあるデバイスは重複として除外)。実際に追加した分を返す (g_lock内で呼ぶ)
+# 同じ分のレコードが無ければ、その分のレコードとして時刻順に挿入する
+# アーカイブ済みの分(前日分)はrecord.txtに書かない(翌日のアーカイブに前日の分が混ざるため。DBモードならDBのみに記録)
+def merge_record(rec):
+	add = recdelta.merge(g_data, rec)
+	if add[1]:
+		if add[0] <= g_sent_ut:
+			g_dirty.add(add[0])
+		if add[0] >= g_rec_start:
+			write_record(add + [recdelta.MERGE]) # 起動時とアーカイブ時に復元
+	return add
+
+# 1分毎の収集データを追加して記録
+def add_record(dat):
+	global g_rec_start
+	dbrecs = []
+	with g_lock:
+		# 別ノードから先に届いている分を統合
+		# 同じ分は今回のレコードに含め、それより前の分(収集が止まっていた間など)はその分のレコードとして挿入
+		ut = int(time.time())
+		for m in sorted(g_remote):
+			if m == ut // 60:
+				dat = dat | {k: v for k, v in g_remote.pop(m)[1].items() if k not in dat}
+			elif m < ut // 60:
+				add = merge_record(g_remote.pop(m))
+				if add[1]:
+					dbrecs.append(add)
+
+		# データ更新
+		next = [ut, dat]
+		g_data.append(next)
+		dbrecs.append(next)
+
+		# 最大数を超えたら古いデータを削除
+		trim_data()
+
+		# 強制終了を考慮してRAM disk保存 (定期的にアーカイブしたら削除)
+		rec = next
+		if g_enc: # 差分記録モードなら変化分のみ記録(ファイル先頭は必ずキーフレーム)
+			rec = g_enc.encode(next)
+		write_record(rec)
+
+	# DBモードならまとめて書き込み
+	if g_db:
+		for rec in dbrecs:
+			recdb.add(rec)
+	
+	# 24時間毎に圧縮してアーカイブを作る(途中から始めた場合も23:59分時点でアーカイブ)
+	now = datetime.now()
+	if now.hour == 23 and now.minute == 59:
+		recs = None
+		with g_lock:
+			if not g_db: # DBモードではアーカイブを作らずDBから読み出す(必要ならrecdb.pyでエクスポート)
+				# 別ノードの統合レコードを含む場合があるので、復元して時刻順に並べ直してからアーカイブ
+				with open(REC_FILE, 'r') as fin:
+					recs = recdelta.decode(json.loads('[' + fin.read() + ']'))
+			os.remove(REC_FILE)
+			g_rec_start = day_start(ut + 60) # 次のファイルは翌日分
+			if g_enc: # 次のファイルの先頭はキーフレーム
+				g_enc.reset()
+		if g_db:
+			recdb.flush()
+
+		# 圧縮中に/difなどの応答を止めないよう、ロック外で書き出す
+		if recs is not None:
+			os.makedirs(ARC_PATH, exist_ok=True)
+			with gzip.open(ARC_PATH + '/' + ARC_FILE % now.strftime('%Y%m%d'), mode='wt', encoding='utf-8') as fout:
+				fout.write(',\n'.join([json.dumps(rec, ensure_ascii=False) for rec in encode_records(recs)]))
+				fout.flush()
+
+# 別ノードから受信したレコードを統合
+def merge_remote(node, recs):
+	cnt = 0
+	dbrecs = []
+	with g_lock:
+		for ut, snap in recs:
+			snap = {'%s/%s' % (node, k): v for k, v in snap.items()} # デバイス名はノード名で区別
+			m = ut // 60
+			if not g_data or m > g_data[-1][0] // 60:
+				# まだ記録していない分は、次の記録時に統合
+				g_remote[m] = [g_remote[m][0], g_remote[m][1] | snap] if m in g_remote else [ut, snap]
+				cnt += len(snap)
+				continue
+
+			# 記録済みの分は同じ分のレコードに統合
+			add = merge_record([ut, snap])
+			if add[1]:
+				cnt += len(add[1])
+				dbrecs.append(add)
+
+		trim_data()
+
+	# DBモードなら通常の記録と一緒にまとめて書き込む(DB書き込み中に/difを止めないようロック外で)
+	if g_db:
+		for rec in dbrecs:
+			recdb.add(rec)
+	return cnt
+
+# 受信したスナップショットの形式チェック {デバイス: {'dat': {...}, 'ut': 時刻}}
+def valid_snap(snap):
+	return isinstance(snap, dict) and all(isinstance(v, dict) and isinstance(v.get('dat'), dict) and isinstance(v.get('ut'), int) for v in snap.values())
 
 # SwditchBot(Bluetooth)とAiSEG(WiFi)の干渉を防ぐため順にポーリング
 def collect_iot():
 	# 1分間隔でデータを収集
-	global g_data
 	while True:
 		# スイッチボットキャプチャ(BLEスキャン)
 		left = 60 - datetime.now().second
@@ -74,41 +230,74 @@ def collect_iot():
 		# AiSEG取得(HTTPパース)
 		as2 = aiseg2.get_aiseg2()
 
-		# データ更新
-		next = [int(time.time()), bot | as2]
-		g_data.append(next)
+		add_record(bot | as2)
 
-		# 最大数を超えたら古いデータを削除
-		if len(g_data) > MAX_DATA:
-			g_data.pop(0)
+# 収集を別プロセスで実行し、パイプ経由で受け取る (-pオプション)
+# BLEスキャンやHTMLパースがWebサーバの応答を止めないようにする。プロセス異常時は自動再起動。
+def collect_proc():
+	col = collector.Collector()
+	col.start()
+	for bot, as2 in col.records():
+		add_record(bot | as2)
 
-		# 強制終了を考慮してRAM disk保存 (定期的にアーカイブしたら削除)
-		with open(REC_FILE, 'a') as f:
-			if  f.tell(): # 継続ならJSON整形用にコンマ追加
-				f.write(',\n')
-			f.write(json.dumps(next, ensure_ascii=False))
-			f.flush()
-		
-		# 24時間毎に圧縮してアーカイブを作る(途中から始めた場合も23:59分時点でアーカイブ)
-		now = datetime.now()
-		if now.hour == 23 and now.minute == 59:
-			with open(REC_FILE, 'rb') as fin:
-				os.makedirs(ARC_PATH, exist_ok=True)
-				with gzip.open(ARC_PATH + '/' + ARC_FILE % now.strftime('%Y%m%d'), mode='wb') as fout:
-					shutil.copyfileobj(fin, fout)
-					fout.flush()
-			os.remove(REC_FILE)
+# 収集専用モード(-fオプション)。SwitchBotのデータを集約サーバ(/ing)に転送する
+# 転送できない間はメモリに溜めておき、復帰後にまとめて送る
+def forward_iot(url, node):
+	user, pw = next(iter(g_httpauth.items())) # 集約サーバと同じユーザ/パスワードを使う
+	buf = []
+	while True:
+		# スイッチボットキャプチャ(BLEスキャン)
+		left = 60 - datetime.now().second
+		if left > 0:
+			bot = switchbot.get_switchbot(left)
+		else:
+			bot = {}
+		buf.append([int(time.time()), bot])
+		buf = buf[-MAX_DATA:]
+
+		# 差分エンコードして圧縮転送
+		body = json.dumps({'node': node, 'recs': recdelta.Encoder(FORWARD_KEY).encode_all(buf)}, ensure_ascii=False)
+		try:
+			res = requests.post(url, data=gzip.compress(body.encode()), auth=(user, pw), timeout=FORWARD_TIMEOUT,
+					   headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+			res.raise_for_status()
+			buf = []
+		except requests.exceptions.RequestException as e:
+			print("forward error %d: %s" % (len(buf), e))
 
 @auth.get_password
 def get_pw(username):
     return g_httpauth.get(username)
 
+# ビルド時に圧縮済みのファイルがあれば、Accept-Encodingに応じて選択して返す
+def send_precompressed(dir, path, **kwargs):
+	for enc, ext in PRECOMP:
+		if request.accept_encodings[enc] > 0 and os.path.isfile(os.path.join(dir, path + ext)):
+			res = send_from_directory(dir, path + ext, mimetype=mimetypes.guess_type(path)[0], **kwargs)
+			res.headers['Content-Encoding'] = enc
+			break
+	else:
+		res = send_from_directory(dir, path, **kwargs)
+	res.headers['Vary'] = 'Accept-Encoding'
+	return res
+
 @app.route('/')
 @auth.login_required
 def index():
-	return send_from_directory('.', 'index.html')
+	# ビルド毎に参照するアセット名が変わるので、ETagで毎回再検証させる
+	res = send_precompressed('.', 'index.html')
+	res.headers['Cache-Control'] = 'no-cache'
+	return res
 	#return render_template('index.html')
 
+@app.route('/%s/<path:path>' % ASSET_PATH)
+def send_asset(path):
+	# ハッシュ付きのJS/CSSは公開デモ(docs)と同じでデータを含まないため認証しない
+	# (index.htmlとデータ取得は認証が必要)
+	res = send_precompressed(ASSET_PATH, path)
+	res.headers['Cache-Control'] = 'public, max-age=%d, immutable' % ASSET_AGE
+	return res
+
 @app.route('/<path:path>')
 @auth.login_required
 def send_static_root(path):
@@ -134,11 +323,17 @@ def get_available(year):
 def get_archive(dt):
 	# 圧縮アーカイブされた指定日のデータを返す
 	print("XHR ARC %d" % (dt))
+	if dt and g_db: # DBモードなら指定日の範囲をインデックスで読み出し
+		dat = recdb.export(str(dt), recdelta.Encoder(g_enc.interval) if g_enc else None)
+		if dat:
+			return make_response(gzip.compress(dat))
+
 	if dt: # 指定あり
 		try:
 			with open(ARC_PATH + '/' + ARC_FILE % str(dt), mode='rb') as f:
 				# 効率のためにjsonifyせず素のアーカイブで返す(クライアントで考慮)
 				# ファイル前後にJSON配列にするための括弧("[", "]")が必要なことに留意
+				# 差分記録モードのアーカイブは差分レコードを含む(クライアントで復元)
 				return make_response(f.read()) 
 		except Exception as e:
 			print("get_archive error")
@@ -148,12 +343,20 @@ def get_archive(dt):
 @app.route('/list/<int:year>')
 @auth.login_required
 def get_list(year):
-	# 圧縮アーカイブが存在する年月日を返す
+	# 圧縮アーカイブが存在する年月日と、その版(内容が変わると変わる文字列)を返す
+	# 版はクライアントのキャッシュ検証用 (ファイルはサイズ-更新時刻、DBは行数)
 	print("XHR list %d" % (year))
 	try:
-		valid = [v[3:11] for v in os.listdir(ARC_PATH)]
+		valid = {}
+		for v in os.listdir(ARC_PATH):
+			if v.endswith('.txt.gz'):
+				st = os.stat(ARC_PATH + '/' + v)
+				valid[v[3:11]] = '%d-%d' % (st.st_size, st.st_mtime)
+		if g_db:
+			for day, cnt in recdb.days().items():
+				valid[day] = valid.get(day, '') + 'r%d' % cnt
 		if year:
-			valid = filter(lambda v: int(v[:4]) == year)
+			valid = {k: v for k, v in valid.items() if int(k[:4]) == year}
 		jsondat = jsonify(valid).data
 		compdat = gzip.compress(jsondat)
 		#headers['Content-Encoding'] = 'gzip' #暗黙の圧縮固定
@@ -168,32 +371,109 @@ def get_list(year):
 @auth.login_required
 def get_latest(ut):
 	# 指定時刻以降のデータのみを返す
-	global g_data
+	global g_sent_ut
 	dt = datetime.fromtimestamp(ut)
 	print("XHR Latest %d(%s) %d" % (ut, dt, len(g_data)))
-	start = len(g_data)
-	while start > 0:
-		if g_data[start - 1][0] <= ut: #送信済みのデータを見つけた
-			break
-		start -= 1
+	with g_lock:
+		start = len(g_data)
+		while start > 0:
+			if g_data[start - 1][0] <= ut: #送信済みのデータを見つけた
+				break
+			start -= 1
+
+		# start以降のデータを圧縮して返す
+		print("ret %d %d" % (start, len(g_data) - start))
+		recs = g_data[start:]
+		# クライアントが持っている最終レコード(ut)が残っていれば、差分の基準にする
+		# 送信後に統合したレコードはクライアントの持つ内容と異なる可能性があるのでキーフレームから送る
+		base = g_data[start - 1] if start and g_data[start - 1][0] == ut and ut not in g_dirty else None
+		if recs:
+			g_sent_ut = max(g_sent_ut, recs[-1][0])
 
-	# start以降のデータを圧縮して返す
-	print("ret %d %d" % (start, len(g_data) - start))
-	jsondat = jsonify(g_data[start:]).data
+	# メモリ上に無い古い範囲はDBから読み出す
+	if g_db and start == 0:
+		now  = int(time.time())
+		recs = recdb.get_range(max(ut + 1, now - RANGE_MAX), g_data[0][0] if g_data else now + 1) + recs
+
+	jsondat = jsonify(encode_records(recs, base)).data
 	compdat = gzip.compress(jsondat)
 	#headers['Content-Encoding'] = 'gzip' #暗黙の圧縮固定
 	return make_response(compdat)
 
+@app.route('/rng/<int:st>/<int:ed>')
+@auth.login_required
+def get_range(st, ed):
+	# 指定範囲(st <= ut < ed)のデータを返す
+	print("XHR Range %d-%d" % (st, ed))
+	if g_db:
+		recs = recdb.get_range(st, min(ed, st + RANGE_MAX))
+	else:
+		with g_lock:
+			recs = [v for v in g_data if st <= v[0] < ed]
+
+	jsondat = jsonify(encode_records(recs)).data
+	compdat = gzip.compress(jsondat)
+	return make_response(compdat)
+
+@app.route('/ing', methods=['POST'])
+@auth.login_required
+def ingest():
+	# 別ノード(収集専用モード)からまとめて送られたレコードを統合する
+	try:
+		body = request.get_data()
+		if request.headers.get('Content-Encoding') == 'gzip':
+			body = gzip.decompress(body)
+		obj  = json.loads(body)
+		node = obj['node']
+		recs = recdelta.decode(obj['recs'])
+		if not isinstance(node, str) or not all(isinstance(ut, int) and valid_snap(snap) for ut, snap in recs):
+			raise ValueError('invalid record')
+	except (ValueError, KeyError, TypeError, IndexError, AttributeError, OSError, EOFError, zlib.error) as e:
+		print("ingest error %s" % e)
+		return make_response('', 400) #Bad Request
+
+	cnt = merge_remote(node, recs)
+	print("XHR Ingest %s %d %d" % (node, len(recs), cnt))
+	return jsonify({'recs': len(recs), 'merged': cnt})
+
 ################################################################################
 # main
 ################################################################################
 if __name__ == '__main__':
-	# 保存されたアクティブデータを読み込んでおく
+	parser = argparse.ArgumentParser(description='EnvLog server')
+	parser.add_argument('-p', '--proc', action='store_true', help='SwitchBot/AiSEGの収集を別プロセスで実行')
+	parser.add_argument('-d', '--db', action='store_true', help='SQLite(%s)にデータを保存' % recdb.DB_FILE)
+	parser.add_argument('-k', '--keyframe', type=int, default=0, metavar='N', help='差分記録モード(N分毎にキーフレームを記録)')
+	parser.add_argument('-f', '--forward', metavar='URL', help='収集専用モード(SwitchBotのデータを集約サーバのURL(http://xxx/ing)に転送)')
+	parser.add_argument('-n', '--node', default=os.uname().nodename, help='収集専用モードのノード名(デバイス名の区別に使う)')
+	args = parser.parse_args()
+
+	# ダイジェスト認証のuser/passリスト読み込み
+	g_httpauth = json.load(open(HTTP_AUTH, encoding="utf-8"))
+
+	# 収集専用モードならWebサーバは起動しない
+	if args.forward:
+		forward_iot(args.forward, args.node)
+
+	# 保存されたアクティブデータを読み込んでおく(差分レコードは復元)
 	with open(REC_FILE, 'r') as fin:
-		g_data = json.loads('[' + fin.read() + ']')
+		g_data = recdelta.decode(json.loads('[' + fin.read() + ']'))
+	g_rec_start = day_start(g_data[0][0] if g_data else time.time())
+
+	# 差分記録モード(再起動後の最初の記録はキーフレーム)
+	if args.keyframe > 0:
+		g_enc = recdelta.Encoder(args.keyframe)
+
+	# DBモードなら未書き込みのアクティブデータも登録しておく(登録済みは無視される)
+	if args.db:
+		recdb.open_db()
+		for rec in g_data:
+			recdb.add(rec)
+		recdb.flush()
+		g_db = True
 	
 	# バックグラウンドでデータ生成を開始
-	data_thread = threading.Thread(target=collect_iot, daemon=True)
+	data_thread = threading.Thread(target=collect_proc if args.proc else collect_iot, daemon=True)
 	data_thread.start()
 
 	# Webサーバを起動
@@ -16,7 +16,7 @@ import {
   ReferenceLine,
   ResponsiveContainer,
 } from 'recharts';
-import { AisegObj, PsyChart, PwrChart, TRVChart, CO2Chart, EnvRecord, ArcCache } from './types.ts';
+import { AisegObj, PsyChart, PwrChart, TRVChart, CO2Chart, EnvRecord, RawRecord, CommonData, WattName, WattDelta, ArcCache } from './types.ts';
 import { testdat } from './@SampleDat.ts'; //　dev時は開発用テストデータにエイリアスで切り替え
 import './App.css';
 import 'react-datepicker/dist/react-datepicker.css';
@@ -84,6 +84,11 @@ const VIEW_RANGES = [1, 2, 3, 4, 6, 12, 24, 48, 72, 96, 120, 168];
 
 // アーカイブのキャッシュ設定
 const ARC_CACHE_SIZE = 20;        // 最大20日分をキャッシュする。(メモリ肥大を避けるため、古いデータは順次削除)
+const IDB_CACHE_SIZE = 60;        // IndexedDBには最大60日分を保存する。(リロード後も再利用)
+const IDB_NAME       = 'envlogv'; // IndexedDBのDB名
+const IDB_VERSION    = 2;         // IndexedDBのスキーマ版(変更時はストアを作り直す)
+const IDB_STORE      = 'arc';     // アーカイブ保存用ストア(キーはYYYYMMDD、値はデコード済データ)
+const IDB_META       = 'meta';    // アーカイブの利用時刻/版の保存用ストア(キーはYYYYMMDD)
 
 // X軸(時刻)の切れの良い間隔
 const DAYTICK_STEP = [1, 5, 10, 15, 20, 30, 60, 60 * 2, 60 * 3, 60 * 4, 60 * 6, 60 * 8, 60 * 12]; // 分単位
@@ -249,6 +254,140 @@ const SliceViewData = (active: EnvRecord[], cache:ArcCache, rangeM:number, start
   return merge;
 };
 
+// 電力リストの差分を前のリストに適用
+const PatchWatt = (prev: unknown, val: unknown): unknown => {
+  if (val === null || typeof val !== 'object' || Array.isArray(val)) return val; // 差分でなければそのまま
+  const old = prev as WattName[];
+  const d   = val as WattDelta;
+  if ('w' in d) return d.w.map((w, i): WattName => [w, old[i][1]]);
+  return d.r.map(([w, r]): WattName => [w, typeof r === 'number'? old[r][1] : r]);
+};
+
+// 差分レコードを直前のレコードに適用してフルデータに復元
+// 受信データの先頭はキーフレーム。ただし/difは受信済みの最終レコード(base)からの差分で始まる場合がある
+const DecodeRecords = (recs: RawRecord[], base: CommonData = {}): EnvRecord[] => {
+  let last = base;
+  return recs.map((rec): EnvRecord => {
+    if (rec.length === 3) {
+      const cur = { ...last };
+      for (const [key, v] of Object.entries(rec[1])) {
+        if (v === null) {
+          delete cur[key]; // 消えたデバイス
+          continue;
+        }
+        const old: {[key: string]: unknown} = { ...last[key]?.dat };
+        const dat: {[key: string]: unknown} = { ...old };
+        for (const [k, val] of Object.entries(v.dat)) dat[k] = PatchWatt(old[k], val);
+        for (const k of Object.keys(dat)) if (dat[k] === null) delete dat[k]; // 消えた項目
+        cur[key] = {dat: dat as CommonData[string]['dat'], ut: v.ut ?? rec[0]};
+      }
+      last = cur;
+    } else {
+      last = rec[1];
+    }
+    return [rec[0], last];
+  });
+};
+
+// 最新モードで受信したアクティブデータをviewに追加し、表示範囲外になった先頭をカット(再結合せずに更新)
+const AppendViewData = (view: EnvRecord[], recs: EnvRecord[], rangeM: number): void => {
+  view.push(...recs);
+  const startM = ((view[view.length - 1][0] / 60 + 1) | 0) - rangeM;
+  let cut = 0;
+  while (cut < view.length - 1 && (view[cut][0] / 60 | 0) < startM) cut++;
+  if (cut) view.splice(0, cut);
+};
+
+// アーカイブの永続キャッシュ(IndexedDB)。使えない環境ではメモリキャッシュのみで動作する
+// データ本体(IDB_STORE)とは別に、小さな管理情報(IDB_META)で利用時刻と版を持つ(削除判定でデータ本体を読まないため)
+type IdbMeta = { ut: number; ver: string; };
+let idbOpen: Promise<IDBDatabase> | null = null;
+const IdbOpen = (): Promise<IDBDatabase> => {
+  if (!idbOpen) {
+    idbOpen = new Promise((resolve, reject) => {
+      const req = indexedDB.open(IDB_NAME, IDB_VERSION);
+      req.onupgradeneeded = () => {
+        // キャッシュなので旧版のストアは破棄して作り直す
+        const db = req.result;
+        for (const store of [IDB_STORE, IDB_META]) {
+          if (db.objectStoreNames.contains(store)) db.deleteObjectStore(store);
+          db.createObjectStore(store);
+        }
+      };
+      req.onsuccess = () => resolve(req.result);
+      req.onerror   = () => reject(req.error);
+    });
+  }
+  return idbOpen;
+};
+// 1ストアへの単発の読み出し
+const IdbRequest = <T,>(name: string, fn: (store: IDBObjectStore) => IDBRequest<T>): Promise<T> =>
+  IdbOpen().then(db => new Promise((resolve, reject) => {
+    const req = fn(db.transaction(name, 'readonly').objectStore(name));
+    req.onsuccess = () => resolve(req.result);
+    req.onerror   = () => reject(req.error);
+  }));
+// データ本体と管理情報をまとめて更新(1トランザクション)
+const IdbWrite = (fn: (arc: IDBObjectStore, meta: IDBObjectStore) => void): Promise<void> =>
+  IdbOpen().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction([IDB_STORE, IDB_META], 'readwrite');
+    fn(tx.objectStore(IDB_STORE), tx.objectStore(IDB_META));
+    tx.oncomplete = () => resolve();
+    tx.onerror    = () => reject(tx.error);
+    tx.onabort    = () => reject(tx.error);
+  }));
+const IdbDelArc = (dt: IDBValidKey) => IdbWrite((arc, meta) => { arc.delete(dt); meta.delete(dt); });
+// 利用時刻を更新(メモリキャッシュの再利用時も呼ぶ)。版が未確定なら確定した版も記録
+const IdbTouchArc = (dt: string, ver: string) => IdbWrite((_arc, meta) => {
+  const req = meta.get(dt);
+  req.onsuccess = () => { if (req.result !== undefined) meta.put({ut: Date.now(), ver: ver || req.result.ver}, dt); };
+});
+const IdbGetArc = async (dt: string): Promise<{dat: EnvRecord[]; ver: string} | undefined> => {
+  const meta: IdbMeta | undefined = await IdbRequest(IDB_META, store => store.get(dt));
+  if (meta === undefined) return undefined;
+  const dat: EnvRecord[] | undefined = await IdbRequest(IDB_STORE, store => store.get(dt));
+  if (dat === undefined) return undefined;
+  return {dat: dat, ver: meta.ver};
+};
+// 管理情報を[キー, 情報]で列挙 (データ本体は読まない。カーソルで1トランザクション)
+const IdbGetMetas = (): Promise<[IDBValidKey, IdbMeta][]> =>
+  IdbOpen().then(db => new Promise((resolve, reject) => {
+    const metas: [IDBValidKey, IdbMeta][] = [];
+    const req = db.transaction(IDB_META, 'readonly').objectStore(IDB_META).openCursor();
+    req.onsuccess = () => {
+      const cursor = req.result;
+      if (!cursor) return resolve(metas);
+      metas.push([cursor.key, cursor.value]);
+      cursor.continue();
+    };
+    req.onerror = () => reject(req.error);
+  }));
+const IdbPutArc = async (dt: string, dat: EnvRecord[], ver: string) => {
+  await IdbWrite((arc, meta) => { arc.put(dat, dt); meta.put({ut: Date.now(), ver: ver}, dt); });
+  // 保存数を超えたら最も古く使われたものを削除 (管理情報だけを読む)
+  const metas = await IdbGetMetas();
+  if (metas.length <= IDB_CACHE_SIZE) return;
+  let idx = 0;
+  for(let i = metas.length; --i > 0;) if (metas[i][1].ut < metas[idx][1].ut) idx = i;
+  await IdbDelArc(metas[idx][0]);
+};
+// サーバのアーカイブリストに無いもの(削除されたアーカイブ)や版が変わったもの(再生成されたアーカイブ)を破棄
+// 版が未確定(リスト取得前に保存)のものはリストの版を採用
+const IdbSyncList = async (list: {[key: string]: string}) => {
+  const metas = await IdbGetMetas();
+  await IdbWrite((arc, store) => {
+    for (const [key, meta] of metas) {
+      const ver = list[key as string];
+      if (ver === undefined || (meta.ver && meta.ver !== ver)) {
+        arc.delete(key);
+        store.delete(key);
+      } else if (!meta.ver) {
+        store.put({...meta, ver: ver}, key);
+      }
+    }
+  });
+};
+
 // gzip展開
 const TEXT_DECODER = new TextDecoder();
 export async function decompress(buffer: ArrayBuffer): Promise<string> {
@@ -1104,13 +1243,13 @@ const App = () => {
   const arcListRef = useRef<Set<string>>(new Set([]));
   useEffect(() => {
     const fetchArcList = async () => {
-      let json:string[] = [];
+      let json:{[key: string]: string} = {}; // YYYYMMDD: 版(アーカイブが更新されると変わる)
       try {
         const response = await fetch('/list/0'); // 0=全ての年のリストを一括取得(10年分でも3650個程度)
         const arraybuf = await response.arrayBuffer();
         const restored = await decompress(arraybuf);
         json = JSON.parse(restored);
-        console.log('Fetch List:', json.length, 'days, ', arraybuf.byteLength, '=>', restored.length, 'byte');
+        console.log('Fetch List:', Object.keys(json).length, 'days, ', arraybuf.byteLength, '=>', restored.length, 'byte');
       } catch (e) {
         // 取得が失敗したらウェイト後にリトライ（asyncは一度抜けてタイマ駆動する）
         console.log('Fetch List: failed. Retry', LIST_FETCH_RETRY / 60000, 'min');
@@ -1123,9 +1262,33 @@ const App = () => {
         return;
       }
 
+      // リストに無いアーカイブや版が変わったアーカイブはキャッシュから破棄 (版が未確定のものはリストの版を採用)
+      arcVerRef.current = json;
+      IdbSyncList(json).catch(() => console.log('IndexedDB: sync failed'));
+      let dropped = false;
+      for (const [dt, cache] of Object.entries(arcCacheRef.current)) {
+        const ver = json[dt];
+        if (ver === undefined || (cache.ver && cache.ver !== ver)) {
+          delete arcCacheRef.current[dt];
+          dropped = true;
+          console.log('Drop cache', dt);
+        } else {
+          cache.ver = ver;
+        }
+      }
+
       // 当日はアクティブデータがあるので無条件に追加
-      json.push(GetYYYYMMDD(new Date()));
-      arcListRef.current = new Set(json); // 全体更新
+      const list = new Set(Object.keys(json));
+      list.add(GetYYYYMMDD(new Date()));
+      arcListRef.current = list; // 全体更新
+
+      // 破棄したデータを表示から外し、必要なら取り直す
+      if (dropped) {
+        UpdateView();
+        CalcScale();
+        SetArcCacheQueue();
+        fetchArcData();
+      }
     };
 
     // リストの初回フェッチはデータ取得/描画を優先して遅延実行させる(リストはオプション操作するまで不要なので後で良い)
@@ -1136,6 +1299,18 @@ const App = () => {
   // アーカイブデータのフェッチ (ARC_CACHE_SIZE分まではキャッシュに貯めて再利用)
   const arcQueueRef = useRef<string[]>([]);
   const arcCacheRef = useRef<ArcCache>({});
+  const arcVerRef   = useRef<{[key: string]: string} | null>(null); // アーカイブリストの版(リスト取得前はnull)
+  const AddArcCache = (dt: string, dat: EnvRecord[], ver: string) => {
+    // 古いキャッシュの削除
+    const items = Object.entries(arcCacheRef.current);
+    if (items.length >= ARC_CACHE_SIZE) {
+      let idx = 0;
+      for(let i = items.length; --i > 0;) if (items[i][1].ut < items[idx][1].ut) idx = i;
+      delete arcCacheRef.current[items[idx][0]];
+      console.log('Del cache', items[idx][0]);
+    }
+    arcCacheRef.current[dt] = {dat: dat, ut: Date.now(), ver: ver};
+  };
   const fetchArcData = async () => {
     let limit = 9; // 一回でダウンロード可能なアーカイブ数(過剰に通信しすぎないためのリミット)
     while(limit--) {
@@ -1147,10 +1322,29 @@ const App = () => {
 
       // キャッシュ不要なキューをスキップ
       const dt    = arcQueueRef.current[0];
-      const cache = arcCacheRef.current[dt];
+      let   cache: ArcCache[string] | undefined = arcCacheRef.current[dt];
+      if (cache === undefined) {
+        // リロード前にダウンロード済みならIndexedDBから復元
+        // リスト取得済みなら版を確認し、古いもの(リストに無い/版が異なる)は破棄して取り直す。リスト取得前ならリスト取得時に確認
+        try {
+          const saved = await IdbGetArc(dt);
+          const list  = arcVerRef.current;
+          if (saved !== undefined && list && (list[dt] === undefined || (saved.ver && saved.ver !== list[dt]))) {
+            IdbDelArc(dt).catch(() => console.log('IndexedDB: delete failed', dt));
+            console.log('fetchArcData drop stale cache', dt);
+          } else if (saved !== undefined) {
+            AddArcCache(dt, saved.dat, list? list[dt] : saved.ver);
+            cache = arcCacheRef.current[dt];
+            console.log('fetchArcData restore cache', dt);
+          }
+        } catch (e) {
+          console.log('IndexedDB: get failed', dt);
+        }
+      }
       if (cache !== undefined) {
         // 既にキャッシュ済みならタッチして終了
         cache.ut = Date.now();// キャッシュ利用時刻だけ更新
+        IdbTouchArc(dt, cache.ver).catch(() => console.log('IndexedDB: touch failed', dt));
         arcQueueRef.current = arcQueueRef.current.slice(1);
         console.log('fetchArcData update cache', dt);
       } else if (arcListRef.current.has(dt)){
@@ -1160,21 +1354,18 @@ const App = () => {
           const response = await fetch('/arc/' + dt);
           const arraybuf = await response.arrayBuffer();
           const restored = await decompress(arraybuf);
-          const json: EnvRecord[] = JSON.parse('[' + restored + ']'); // 前後に'[...]'を入れて配列にしてパース
+          const json = DecodeRecords(JSON.parse('[' + restored + ']')); // 前後に'[...]'を入れて配列にしてパース
           console.log('Fetch Arc:', dt, json.length, 'min, ', arraybuf.byteLength, '=>', restored.length, 'byte');
 
-          // 古いキャッシュの削除
-          const items = Object.entries(arcCacheRef.current);
-          if (items.length >= ARC_CACHE_SIZE) {
-            let idx = 0;
-            for(let i = items.length; --i > 0;) if (items[i][1].ut < items[idx][1].ut) idx = i;
-            delete arcCacheRef.current[items[idx][0]];
-            console.log('Del cache', items[idx][0]);
-          }
-  
           // キャッシュに追加してfetchキューから削除
-          arcCacheRef.current[dt] = {dat:json, ut: Date.now()};
+          const ver = arcVerRef.current?.[dt] ?? ''; // リスト取得前なら版は未確定(リスト取得時に確定)
+          AddArcCache(dt, json, ver);
           arcQueueRef.current = arcQueueRef.current.slice(1);
+
+          // 当日分(途中のデータの可能性あり)以外はIndexedDBにも保存
+          if (dt < GetYYYYMMDD(new Date())) {
+            IdbPutArc(dt, json, ver).catch(() => console.log('IndexedDB: put failed', dt));
+          }
         } catch (e) {
           console.log('Fetch Arc: failed', dt);
           break; // 残りがあっても中断しておく
@@ -1198,7 +1389,8 @@ const App = () => {
         const response = await fetch('/dif/' + lastFetchRef.current); // 差分データ要求リクエスト
         const arraybuf = await response.arrayBuffer();
         const restored = await decompress(arraybuf);
-        const json: EnvRecord[] = JSON.parse(restored);
+        const active = activeDatRef.current;
+        const json = DecodeRecords(JSON.parse(restored), active.length? active[active.length - 1][1] : {}); // 受信済みの最終レコードが差分の基準
         if (json.length) {
           // データを受信できたら配列末尾に結合し、必要に応じて古くなったデータを先頭から破棄
           lastFetchRef.current = json[json.length - 1][0];
@@ -1208,7 +1400,7 @@ const App = () => {
           console.log('Fetch Diff:', json.length, 'min, ', arraybuf.byteLength, '=>', restored.length, 'byte');
 
           // 最新データを更新
-          UpdateView();
+          UpdateView(json);
           CalcScale();
 
           // ArcListにも当日分を追加しておく　（アーカイブが無くてもアクティブデータから参照できる）
@@ -1241,9 +1433,17 @@ const App = () => {
 
   // View切り出し 
   // フェッチしたデータ(activeDatRef/arcCacheRef)、または表示レンジ(options.rangeM/options.dateSel/options.datetimeM)が変更されたときに更新
-  const UpdateView = () => {
+  // 最新モードで新規データ(recs)だけが増えた場合は、view全体を作り直さずに追加する
+  const viewRangeRef = useRef(0); // 最新モードで作成したviewの表示期間(0:日付指定モードで作成)
+  const UpdateView = (recs: EnvRecord[] = []) => {
     const option = optionRef.current;
-    viewdatRef.current = SliceViewData(activeDatRef.current, arcCacheRef.current, option.rangeM, option.dateSel? option.datetimeM.getTime() / 60000 | 0 : 0);
+    const view   = viewdatRef.current;
+    if (recs.length && !option.dateSel && viewRangeRef.current === option.rangeM && view.length && view[view.length - 1][0] < recs[0][0]) {
+      AppendViewData(view, recs, option.rangeM);
+    } else {
+      viewdatRef.current  = SliceViewData(activeDatRef.current, arcCacheRef.current, option.rangeM, option.dateSel? option.datetimeM.getTime() / 60000 | 0 : 0);
+      viewRangeRef.current = option.dateSel? 0 : option.rangeM;
+    }
     calcGraph();
   };
 
@@ -17,54 +17,77 @@ import datetime
 # globals
 ################################################################################
 
+# 電力リストの差分({'w': [W, ...]} or {'r': [[W, 位置 or 名前], ...]})を前のリストに適用
+def patch_watt(prev, val):
+    if not isinstance(val, dict):
+        return val
+    if 'w' in val:
+        return [[w, prev[i][1]] for i, w in enumerate(val['w'])]
+    return [[w, prev[r][1] if isinstance(r, int) else r] for w, r in val['r']]
+
+# 差分レコード([ut, {変化分}, 'd'])を直前のスナップショットに適用して復元しながら読む
+def read_records(file):
+    last = {}
+    with open(file, 'r', encoding='utf-8') as f:
+        for line in f:
+            obj = json.loads(line.rstrip(',\n'))
+            if len(obj) > 2 and obj[2] == 'd':
+                cur = dict(last)
+                for key, value in obj[1].items():
+                    if value is None:
+                        cur.pop(key, None)
+                        continue
+                    old = last[key]['dat'] if key in last else {}
+                    dat = old | {k: patch_watt(old.get(k), v) for k, v in value['dat'].items()}
+                    cur[key] = {'dat': {k: v for k, v in dat.items() if v is not None}, 'ut': value.get('ut', obj[0])}
+                obj = [obj[0], cur]
+            last = obj[1]
+            yield obj
+
 def arc2csv(files):
     colA = set()
     colB = set()
     colC = set()
     for file in files:
-        with open(file, 'r', encoding='utf-8') as f:
-            for line in f:
-                obj = json.loads(line.rstrip(',\n'))
-                for key, value in obj[1].items():
-                     dat = value['dat']
-                     if 'dcE1' in dat:
-                          colA.add(dat['name'] + '温度[℃]')
-                     if 'rh' in dat:
-                          colA.add(dat['name'] + '湿度[%]')
-                     if 'CO2' in dat:
-                          colA.add(dat['name'] + 'CO2濃度[ppm]')
-                     if 'gen' in dat:
-                          for ar in dat['gen']:
-                            colB.add(ar[1] + '[W]')
-                     if 'use' in dat:
-                          for ar in dat['use']:
-                            colC.add(ar[1] + '[W]')
-                          
+        for obj in read_records(file):
+            for key, value in obj[1].items():
+                 dat = value['dat']
+                 if 'dcE1' in dat:
+                      colA.add(dat['name'] + '温度[℃]')
+                 if 'rh' in dat:
+                      colA.add(dat['name'] + '湿度[%]')
+                 if 'CO2' in dat:
+                      colA.add(dat['name'] + 'CO2濃度[ppm]')
+                 if 'gen' in dat:
+                      for ar in dat['gen']:
+                        colB.add(ar[1] + '[W]')
+                 if 'use' in dat:
+                      for ar in dat['use']:
+                        colC.add(ar[1] + '[W]')
+                      
     print('%d件' % len(dat))
     collist = sorted(list(colA), reverse=True) + sorted(list(colB)) + sorted(list(colC))
     print('時刻,%s' % ','.join(collist))
 
     for file in files:
-        with open(file, 'r', encoding='utf-8') as f:
-            for line in f:
-                cols = [''] * len(collist)
-                obj = json.loads(line.rstrip(',\n'))
-                for key, value in obj[1].items():
-                     dat = value['dat']
-                     if 'dcE1' in dat:
-                          cols[collist.index(dat['name'] + '温度[℃]')] = dat['dcE1'] / 10
-                     if 'rh' in dat:
-                          cols[collist.index(dat['name'] + '湿度[%]')] = dat['rh']
-                     if 'CO2' in dat:
-                          cols[collist.index(dat['name'] + 'CO2濃度[ppm]')] = dat['CO2']
-                     if 'gen' in dat:
-                          for ar in dat['gen']:
-                            cols[collist.index(ar[1] + '[W]')] = ar[0]
-                     if 'use' in dat:
-                          for ar in dat['use']:
-                            cols[collist.index(ar[1] + '[W]')] = ar[0]
-                print('%s,%s' % (datetime.datetime.fromtimestamp(obj[0]).strftime('%Y/%m/%d %H:%M'), ','.join([str(i) for i in cols])))
-                        
+        for obj in read_records(file):
+            cols = [''] * len(collist)
+            for key, value in obj[1].items():
+                 dat = value['dat']
+                 if 'dcE1' in dat:
+                      cols[collist.index(dat['name'] + '温度[℃]')] = dat['dcE1'] / 10
+                 if 'rh' in dat:
+                      cols[collist.index(dat['name'] + '湿度[%]')] = dat['rh']
+                 if 'CO2' in dat:
+                      cols[collist.index(dat['name'] + 'CO2濃度[ppm]')] = dat['CO2']
+                 if 'gen' in dat:
+                      for ar in dat['gen']:
+                        cols[collist.index(ar[1] + '[W]')] = ar[0]
+                 if 'use' in dat:
+                      for ar in dat['use']:
+                        cols[collist.index(ar[1] + '[W]')] = ar[0]
+            print('%s,%s' % (datetime.datetime.fromtimestamp(obj[0]).strftime('%Y/%m/%d %H:%M'), ','.join([str(i) for i in cols])))
+                    
 
 
 ################################################################################
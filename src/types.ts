@@ -56,7 +56,7 @@ type ContactObj = {
 };
 
 // 共通シグネチャ
-type CommonData = {
+export type CommonData = {
 	[key: string]: { // 各デバイス名がキー名
 		dat:	AisegObj | MeterObj | CO2Obj | BulbObj | PlugObj | ContactObj;
 		ut:		number; // 該当データの更新時刻
@@ -66,11 +66,26 @@ type CommonData = {
 // 集計時刻付きレコード
 export type EnvRecord = [number, CommonData];
 
+// 差分レコード (サーバの差分記録モード。前レコードから変化したデバイス/項目のみで、nullは削除)
+// 電力リスト(WattName[])は、名前の並びが同じなら{w:[W...]}、変わったら{r:[[W, 前リストの位置 or 名前]...]}
+export type WattDelta = {w: number[]} | {r: [number, number | string][]};
+type DeltaData = {
+	[key: string]: {
+		dat:	{[key: string]: unknown};
+		ut?:	number;		// 省略時はレコードの集計時刻
+	} | null
+};
+export type EnvDeltaRecord = [number, DeltaData, 'd'];
+
+// 受信レコード(キーフレーム or 差分)
+export type RawRecord = EnvRecord | EnvDeltaRecord;
+
 // アーカイブのキャッシュ
 export type ArcCache = {
 	[key: string]: { 		// キャッシュファイル名のYYYYMMDDがキー
 		dat: EnvRecord[];	// デコード済データ (圧縮状態のまま保持すべきか?)
 		ut:   number; 		// キャッシュ追加時刻(古いものから消していく)
+		ver:  string;		// アーカイブの版(/listの値。''は未確定)
 	}
 };
 
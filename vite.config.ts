@@ -1,6 +1,17 @@
 import { defineConfig } from 'vite'
 import react from '@vitejs/plugin-react-swc'
 import { execSync } from 'child_process';
+import { readdirSync, readFileSync, writeFileSync } from 'fs';
+import { gzipSync, brotliCompressSync, constants } from 'zlib';
+
+// サーバ配信用に圧縮済みファイル(.br/.gz)を生成。webapp.pyがAccept-Encodingに応じて選択する
+const precompress = (files: string[]) => {
+  for (const file of files) {
+    const dat = readFileSync(file);
+    writeFileSync(file + '.gz', gzipSync(dat, { level: 9 }));
+    writeFileSync(file + '.br', brotliCompressSync(dat, { params: { [constants.BROTLI_PARAM_QUALITY]: 11 } }));
+  }
+};
 
 // https://vite.dev/config/
 
@@ -16,6 +27,14 @@ export default defineConfig(({ mode }) => {
           execSync('cp dist/index.html dist/favicon.png dist/manifest.json docs/');
           execSync(`sed -i 's/="\\//="/' docs/index.html`);
         }
+      },
+      mode === 'production' && {
+        name:'precompress',
+        apply: 'build',
+        closeBundle: () => {
+          const assets = readdirSync('dist/assets').filter(v => /\.(js|css)$/.test(v)).map(v => 'dist/assets/' + v);
+          precompress(['dist/index.html', ...assets]);
+        }
       }
     ],
     resolve: {